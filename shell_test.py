@@ -1,7 +1,12 @@
 #!/usr/bin/env python3
-from __future__ import print_function, unicode_literals
 
+import argparse
+import array
+import collections
+import concurrent.futures
 import errno
+import functools
+import io
 import logging
 import os
 import re
@@ -9,9 +14,52 @@ import resource
 import subprocess
 import sys
 import tempfile
+import threading
+import time
+import types
+
+# Debug messages use lazy %-style arguments, so nothing is formatted unless
+# they are shown (set SHELL_TEST_DEBUG to see them).
+log = logging.getLogger(__name__)
 
 PROGRAM = ['./msh']
 
+# Used to mark test boundaries when several tests are fed to one shell (--batch).
+SENTINEL_PROGRAM = 'test/sentinel.sh'
+BATCH_SIZE = 16
+# The only stdout a batch shell may print after its last sentinel: the prompt
+# it shows before reading the final 'exit'.
+BATCH_FINAL_PROMPT = b'> '
+
+# Errors kept per test; the rest are only counted.
+MAX_ERRORS = 8
+
+def create_file(filename, contents):
+    with open(filename, 'w') as fh:
+        fh.write(contents)
+
+def _limit_nofile_50():
+    resource.setrlimit(resource.RLIMIT_NOFILE, (50,50))
+
+def _limit_nproc_0():
+    resource.setrlimit(resource.RLIMIT_NPROC, (0,0))
+
+try:
+    _INPUT_STAT = os.stat('test/input.txt')
+except OSError:
+    # keep the module importable without the test data; the inode test will fail
+    _INPUT_STAT = None
+
+# Written before the "truncates file" tests; longer than what the shell writes back.
+TRUNCATE_CHECK_CONTENTS = (
+    'This is a long string meant to ensure that echo\n'
+    'will not overwrite it if the shell does not open\n'
+    'the file with O_TRUNC.\n'
+    'This is a long string meant to ensure that echo\n'
+    'will not overwrite it if the shell does not open\n'
+    'the file with O_TRUNC.\n'
+)
+
 # Notes on interpreting this test cases:
 #
 # The expected values for stdout and stderr are regular expressions, so
@@ -238,7 +286,7 @@ NON_PIPE_TESTS = [
     },
     {
         'name': 'lots of arguments',
-        'input': ['/bin/echo short', 'test/argument_test.sh ' + ' '.join(map(lambda i: chr(ord('A') + i), range(20))), 'exit'],
+        'input': ['/bin/echo short', 'test/argument_test.sh ' + ' '.join(chr(ord('A') + i) for i in range(20)), 'exit'],
         'stdout': [
             '> short',
             '.*exit status: 0.*',
@@ -281,10 +329,8 @@ NON_PIPE_TESTS = [
         'name': 'redirect stdin inode',
         'input': ['/usr/bin/stat -L -c %i/%d /proc/self/fd/0 < test/input.txt', 'exit'],
         'stdout': [
-            '> {}/{}'.format(
-                os.stat('test/input.txt').st_ino,
-                os.stat('test/input.txt').st_dev,
-            ),
+            '> {}/{}'.format(_INPUT_STAT.st_ino, _INPUT_STAT.st_dev)
+                if _INPUT_STAT != None else '> <test/input.txt is missing>',
             '.*exit status: 0.*',
             '> ',
         ],
@@ -308,7 +354,7 @@ NON_PIPE_TESTS = [
         'stderr': ['.+'], # some non-empty error message
         'allow_extra_stderr': True,
         'extra_popen': {
-            'preexec_fn': lambda: resource.setrlimit(resource.RLIMIT_NPROC, (0,0)),
+            'preexec_fn': _limit_nproc_0,
         },
     },
     {
@@ -389,51 +435,41 @@ NON_PIPE_TESTS = [
         },
         'stdout': ['.*exit status: 0.*', '> '],
         'stderr': [],
-        'prepare_function': lambda: create_file('test/redirect-stdout-output.txt',
-            'This is a long string meant to ensure that echo\n'
-            'will not overwrite it if the shell does not open\n'
-            'the file with O_TRUNC.\n'
-            'This is a long string meant to ensure that echo\n'
-            'will not overwrite it if the shell does not open\n'
-            'the file with O_TRUNC.\n'
-        ),
+        'prepare_function': functools.partial(create_file, 'test/redirect-stdout-output.txt', TRUNCATE_CHECK_CONTENTS),
     },
     {
         'name': 'echo 100 times output',
-        'input': list(map(lambda i: '/bin/echo %s' % (i), range(100))) + ['exit'],
-        'stdout': list(map(lambda i: '.*%s' % (i), range(100))), # .* for possible prefix of prompt
+        'input': ['/bin/echo %s' % i for i in range(100)] + ['exit'],
+        'stdout': ['.*%s' % i for i in range(100)], # .* for possible prefix of prompt
         'stderr': [],
         'allow_extra_stdout': True,
     },
     {
         'name': 'echo 100 times exit status',
-        'input': list(map(lambda i: '/bin/echo %s' % (i), range(100))) + ['exit'],
-        'stdout': list(map(lambda i: '.*exit status: 0.*', range(100))),
+        'input': ['/bin/echo %s' % i for i in range(100)] + ['exit'],
+        'stdout': ['.*exit status: 0.*'] * 100,
         'stderr': [],
         'allow_extra_stdout': True,
     },
     {
         'name': '100 output redirections (with limit of 50 open files)',
-        'input': list(map(lambda i: '/bin/echo valuefrom%s > test/redirect-output-%s' % (i, i), range(100))) + ['exit'],
-        'stdout': list(map(lambda i: '.*exit status: 0.*', range(100))),
+        'input': ['/bin/echo valuefrom%s > test/redirect-output-%s' % (i, i) for i in range(100)] + ['exit'],
+        'stdout': ['.*exit status: 0.*'] * 100,
         'stderr': [],
-        'expect_output_files': dict(list(map(
-            lambda i: ('test/redirect-output-%s' % (i), ['valuefrom%s' % (i)]),
-            range(100)
-        ))),
+        'expect_output_files': {'test/redirect-output-%s' % i: ['valuefrom%s' % i] for i in range(100)},
         'allow_extra_stdout': True,
         'extra_popen': {
-            'preexec_fn': lambda: resource.setrlimit(resource.RLIMIT_NOFILE, (50,50)),
+            'preexec_fn': _limit_nofile_50,
         },
     },  
     {
         'name': '100 input redirections (with limit of 50 open files)',
-        'input': list(map(lambda i: '/bin/cat < test/input.txt', range(100))) + ['exit'],
-        'stdout': list(map(lambda i: '.*This is an example input file.', range(100))),
+        'input': ['/bin/cat < test/input.txt'] * 100 + ['exit'],
+        'stdout': ['.*This is an example input file.'] * 100,
         'stderr': [],
         'allow_extra_stdout': True,
         'extra_popen': {
-            'preexec_fn': lambda: resource.setrlimit(resource.RLIMIT_NOFILE, (50,50)),
+            'preexec_fn': _limit_nofile_50,
         },
     },
     {
@@ -525,14 +561,7 @@ NON_PIPE_TESTS = [
         'expect_output_files': {
             'test/redirect-stdout-output.txt': ['foo bar baz']
         },
-        'prepare_function': lambda: create_file('test/redirect-stdout-output.txt',
-            'This is a long string meant to ensure that echo\n'
-            'will not overwrite it if the shell does not open\n'
-            'the file with O_TRUNC.\n'
-            'This is a long string meant to ensure that echo\n'
-            'will not overwrite it if the shell does not open\n'
-            'the file with O_TRUNC.\n'
-        ),
+        'prepare_function': functools.partial(create_file, 'test/redirect-stdout-output.txt', TRUNCATE_CHECK_CONTENTS),
         'allow_extra_stdout': True,
     },
 ]
@@ -553,7 +582,7 @@ PIPE_TESTS = [
         'stderr': ['.+'], # some non-empty error message
         'allow_extra_stderr': True,
         'extra_popen': {
-            'preexec_fn': lambda: resource.setrlimit(resource.RLIMIT_NPROC, (0,0)),
+            'preexec_fn': _limit_nproc_0,
         },
     },
     {
@@ -689,12 +718,12 @@ PIPE_TESTS = [
     },
     {
         'name': '100 pipelines (with limit of 50 open files)',
-        'input': list(map(lambda i: '/bin/echo a test | /bin/sed -e s/test/xxx/', range(100))) + ['exit'],
-        'stdout': list(map(lambda i: '.*a xxx', range(100))),
+        'input': ['/bin/echo a test | /bin/sed -e s/test/xxx/'] * 100 + ['exit'],
+        'stdout': ['.*a xxx'] * 100,
         'stderr': [],
         'allow_extra_stdout': True,
         'extra_popen': {
-            'preexec_fn': lambda: resource.setrlimit(resource.RLIMIT_NOFILE, (50,50)),
+            'preexec_fn': _limit_nofile_50,
         },
     },
     {
@@ -718,17 +747,152 @@ PIPE_TESTS = [
 
 TESTS = NON_PIPE_TESTS + PIPE_TESTS
 
-def create_file(filename, contents):
-    with open(filename, 'w') as fh:
-        fh.write(contents)
-
 def to_bytes(s):
     return bytes(s, 'UTF-8')
 
-def bytes_to_lines(s):
-    lines_as_bytes = s.split(b'\n')
-    lines = list(map(lambda s: s.decode('UTF-8', errors='replace'), lines_as_bytes))
-    return lines
+_REGEX_SPECIAL = frozenset(b'\\.^$*+?{}[]|()')
+
+class _WildcardMatcher(object):
+    # Stands in for a compiled pattern made only of literal text and '.*',
+    # which is most of them. fullmatch holds when the literal pieces occur in
+    # order, the first at the start of the line and the last at its end, so no
+    # backtracking is needed. Comparison is case-insensitive for ASCII, like
+    # re.IGNORECASE on bytes.
+    def __init__(self, pieces):
+        self.pieces = [piece.lower() for piece in pieces]
+
+    def fullmatch(self, line):
+        line = line.lower()
+        if len(self.pieces) == 1:
+            return True if line == self.pieces[0] else None
+        first = self.pieces[0]
+        last = self.pieces[-1]
+        if not line.startswith(first):
+            return None
+        position = len(first)
+        for piece in self.pieces[1:-1]:
+            position = line.find(piece, position)
+            if position == -1:
+                return None
+            position += len(piece)
+        if len(line) - len(last) < position or not line.endswith(last):
+            return None
+        return True
+
+# Compiled matchers keep no state, so tests repeating a pattern share one.
+_PATTERN_CACHE = {}
+
+def _compile_pattern(pattern):
+    matcher = _PATTERN_CACHE.get(pattern)
+    if matcher == None:
+        pieces = pattern.split(b'.*')
+        if any(_REGEX_SPECIAL.intersection(piece) for piece in pieces):
+            matcher = re.compile(pattern, re.IGNORECASE | re.DOTALL)
+        else:
+            matcher = _WildcardMatcher(pieces)
+        matcher = _PATTERN_CACHE.setdefault(pattern, matcher)
+    return matcher
+
+def compile_patterns(patterns):
+    return [(pattern, _compile_pattern(pattern)) for pattern in map(to_bytes, patterns)]
+
+def encode_input(lines):
+    return b'\n'.join(line.encode('UTF-8') for line in lines) + b'\n'
+
+def _precompile_tests(tests):
+    for test in tests:
+        test['_input_bytes'] = encode_input(test['input'])
+        test['_compiled_stdout'] = compile_patterns(test['stdout'])
+        test['_compiled_stderr'] = compile_patterns(test['stderr'])
+        test['_compiled_output_files'] = {
+            filename: compile_patterns(expected_contents)
+            for filename, expected_contents in test.get('expect_output_files', {}).items()
+        }
+
+def _warm_pattern_cache(tests):
+    # compile every pattern up front, so tests started concurrently do not each
+    # compile the same patterns while the cache is still empty
+    for test in tests:
+        compile_patterns(test['stdout'])
+        compile_patterns(test['stderr'])
+        for expected_contents in test.get('expect_output_files', {}).values():
+            compile_patterns(expected_contents)
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return types.MappingProxyType({key: _freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+# The test tables are never modified once built; freezing them makes
+# accidental mutation (e.g. from concurrently running tests) an error.
+_precompile_tests(TESTS)
+NON_PIPE_TESTS = _freeze(NON_PIPE_TESTS)
+PIPE_TESTS = _freeze(PIPE_TESTS)
+TESTS = NON_PIPE_TESTS + PIPE_TESTS
+
+class _LineMatcher(object):
+    # Checks lines against the expected patterns as they arrive, so output can
+    # be compared while the shell is still producing it. Each pattern must match
+    # a later line than the previous one; unless extra lines are allowed, every
+    # line must match the next pattern and no lines may follow the last one.
+    def __init__(self, label, expected_lines, allow_extra_lines):
+        self.label = label
+        self.expected_lines = expected_lines
+        self.allow_extra_lines = allow_extra_lines
+        self.errors = []
+        self.next_index = 0
+        self.unmatched = []
+        self.done = False
+        self.decode_calls = 0
+
+    def accepts_anything(self):
+        return self.allow_extra_lines and not self.expected_lines
+
+    def _decode(self, line):
+        # only used to build error messages: a passing comparison stays in bytes
+        self.decode_calls += 1
+        return line.decode('UTF-8', errors='replace')
+
+    def feed(self, line):
+        if self.done:
+            return
+        if self.next_index == len(self.expected_lines):
+            if not self.allow_extra_lines:
+                self.unmatched.append(line)
+            return
+        expected_line, pattern = self.expected_lines[self.next_index]
+        if pattern.fullmatch(line) != None:
+            self.next_index += 1
+            self.unmatched = []
+        elif self.allow_extra_lines:
+            self.unmatched.append(line)
+        else:
+            # a single mismatch already fails the test; later lines are not compared
+            self.errors.append('in {}: could not find a match for pattern [{}] in line [{}]'.format(
+                self.label,
+                self._decode(expected_line),
+                self._decode(line)
+            ))
+            self.done = True
+
+    def finish(self):
+        if not self.done:
+            self.done = True
+            if self.next_index < len(self.expected_lines):
+                self.errors.append('in {}: could not find match for pattern [{}] in {}'.format(
+                    self.label,
+                    self._decode(self.expected_lines[self.next_index][0]),
+                    [self._decode(x) for x in self.unmatched]
+                ))
+            elif self.unmatched:
+                self.errors.append('in {}: unexpected extra output [{}]'.format(
+                    self.label,
+                    [self._decode(x) for x in self.unmatched]
+                ))
+        assert self.errors or self.decode_calls == 0
+        return self.errors
 
 def compare_lines(
         label,
@@ -736,37 +900,177 @@ def compare_lines(
         actual_lines,
         allow_extra_lines,
 ):
-    errors = []
-    actual_index = 0
-    if len(actual_lines) > 0 and actual_lines[-1] == b'':
-        actual_lines = actual_lines[:-1]
-    for expected_line in map(to_bytes, expected_lines):
-        pattern = re.compile(expected_line, re.IGNORECASE)
-        prev_index = actual_index
-        found_match = False
-        while actual_index < len(actual_lines):
-            actual_index += 1
-            m = pattern.fullmatch(actual_lines[actual_index-1])
-            if m != None:
-                found_match = True
-                break
-            if not allow_extra_lines:
-                errors.append('in {}: could not find a match for pattern [{}] in line [{}]'.format(
-                    label,
-                    expected_line.decode('UTF-8', errors='replace'),
-                    actual_lines[actual_index-1].decode('UTF-8', errors='replace')
-                ))
-        if not found_match and actual_index >= len(actual_lines):
-            errors.append('in {}: could not find match for pattern [{}] in {}'.format(
-                label,
-                expected_line.decode('UTF-8', errors='replace'),
-                list(map(lambda x: x.decode('UTF-8', errors='replace'), actual_lines[prev_index:actual_index]))
-            ))
-            break
-    if not allow_extra_lines and actual_index < len(actual_lines):
-        errors.append('in {}: unexpected extra output [{}]'.format(label, list(map(lambda x: x.decode('UTF-8', errors='replace'), actual_lines[actual_index:]))))
+    matcher = _LineMatcher(label, expected_lines, allow_extra_lines)
+    for line in actual_lines:
+        matcher.feed(line)
+    return matcher.finish()
+
+def _compare_output(out_data, err_data, compiled_stdout, compiled_stderr, allow_extra_stdout, allow_extra_stderr):
+    errors = compare_lines(
+        'stdout',
+        compiled_stdout,
+        out_data.splitlines(),
+        allow_extra_lines=allow_extra_stdout,
+    )
+    errors += compare_lines(
+        'stderr',
+        compiled_stderr,
+        err_data.splitlines(),
+        allow_extra_lines=allow_extra_stderr,
+    )
     return errors
 
+def _write_input(stream, data):
+    try:
+        stream.write(data)
+        stream.close()
+    except BrokenPipeError:
+        # the shell exited without reading all of its input
+        pass
+
+def _read_lines(stream, chunks, matcher):
+    # a stream that cannot fail the test is still kept for the report, but
+    # not fed to its matcher
+    feed = not matcher.accepts_anything()
+    for chunk in iter(stream.readline, b''):
+        chunks.append(chunk)
+        if feed:
+            for line in chunk.splitlines():
+                matcher.feed(line)
+
+def _run_shell(input, timeout, extra_popen, stdout_matcher, stderr_matcher):
+    # Output is matched line by line while the shell runs rather than after it
+    # exits. The full output is still kept for the test report.
+    errors = []
+    process = subprocess.Popen(
+        PROGRAM,
+        bufsize=-1,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        **extra_popen
+    )
+    out_chunks = []
+    err_chunks = []
+    threads = [
+        threading.Thread(target=_write_input, args=(process.stdin, input)),
+        threading.Thread(target=_read_lines, args=(process.stdout, out_chunks, stdout_matcher)),
+        threading.Thread(target=_read_lines, args=(process.stderr, err_chunks, stderr_matcher)),
+    ]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    deadline = time.monotonic() + timeout
+    for thread in threads:
+        thread.join(max(0, deadline - time.monotonic()))
+    timed_out = any(thread.is_alive() for thread in threads)
+    if not timed_out:
+        # the shell may close its output and keep running
+        try:
+            process.wait(timeout=max(0, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            timed_out = True
+    if timed_out:
+        process.kill()
+        process.wait()
+    out_data = b''.join(list(out_chunks))
+    err_data = b''.join(list(err_chunks))
+    if timed_out:
+        errors += [ 'timed out after {} seconds'.format(timeout) ]
+        # a reader may still be feeding its matcher, so compare what was
+        # collected up to now instead
+        errors += compare_lines('stdout', stdout_matcher.expected_lines, out_data.splitlines(), stdout_matcher.allow_extra_lines)
+        errors += compare_lines('stderr', stderr_matcher.expected_lines, err_data.splitlines(), stderr_matcher.allow_extra_lines)
+    else:
+        errors += stdout_matcher.finish()
+        errors += stderr_matcher.finish()
+    return process.pid, out_data, err_data, errors
+
+class _LineBuffer(object):
+    # Append-only list of byte lines stored in one contiguous buffer plus an
+    # array of end offsets, instead of one Python object per line. Supports
+    # len() and indexing/slicing (returning bytes), which is all the report needs.
+    def __init__(self):
+        self.data = bytearray()
+        self.ends = array.array('I')
+
+    def append(self, line):
+        self.data += line
+        self.ends.append(len(self.data))
+
+    def __len__(self):
+        return len(self.ends)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('line index out of range')
+        start = self.ends[index - 1] if index > 0 else 0
+        return bytes(self.data[start:self.ends[index]])
+
+# A line mentioning 'leak' counts as a leak even if it also says ERROR
+# (e.g. "ERROR: LeakSanitizer: detected memory leaks"); hence the lookahead.
+_ASAN_CLASSIFY = re.compile(rb'(leak)|ERROR(?!.*leak)')
+
+def _read_asan_logs(asan_dir, pid):
+    asan_errors = _LineBuffer()
+    asan_errors_children = _LineBuffer()
+    leak_error = False
+    non_leak_error = False
+    main_log = 'asan_log.{}'.format(pid)
+    with os.scandir(asan_dir) as entries:
+        for entry in entries:
+            if not entry.name.startswith('asan_log.'):
+                continue
+            is_main = entry.name == main_log
+            with open(entry.path, 'rb') as fh:
+                data = fh.read()
+            for line in data.splitlines():
+                if is_main:
+                    if not (leak_error and non_leak_error):
+                        m = _ASAN_CLASSIFY.search(line)
+                        if m != None:
+                            if m.group(1) != None:
+                                leak_error = True
+                            else:
+                                non_leak_error = True
+                    asan_errors.append(line)
+                else:
+                    asan_errors_children.append(line)
+    return {
+        'asan_errors': asan_errors,
+        'asan_errors_children': asan_errors_children,
+        'asan_leak': leak_error,
+        'asan_non_leak': non_leak_error,
+    }
+
+def _remove_files(filenames):
+    # one directory listing per parent directory, then unlink only what exists,
+    # instead of an unlink attempt (and OSError) for every missing file
+    names_by_directory = {}
+    for filename in filenames:
+        directory, name = os.path.split(filename)
+        names_by_directory.setdefault(directory, set()).add(name)
+    for directory, names in names_by_directory.items():
+        try:
+            with os.scandir(directory or '.') as entries:
+                present = [os.path.join(directory, entry.name) for entry in entries if entry.name in names]
+        except FileNotFoundError:
+            continue
+        for filename in present:
+            try:
+                os.unlink(filename)
+            except OSError:
+                pass
+
+def _limit_errors(errors):
+    if len(errors) <= MAX_ERRORS:
+        return errors
+    return errors[:MAX_ERRORS] + ['... ({} more errors suppressed)'.format(len(errors) - MAX_ERRORS)]
+
 def run_test(
         input,
         stdout,
@@ -782,189 +1086,479 @@ def run_test(
         points=None, # ignored
         category=None, # ignored
         seperate_asan=False,
+        _compiled_stdout=None,
+        _compiled_stderr=None,
+        _input_bytes=None,
+        _compiled_output_files=None,
 ):
+    log.debug('running test %s (timeout %ss)', name, timeout)
+    if _compiled_stdout == None:
+        _compiled_stdout = compile_patterns(stdout)
+    if _compiled_stderr == None:
+        _compiled_stderr = compile_patterns(stderr)
     for filename in expect_output_files.keys():
         if not filename.startswith('test/'):
             raise Exception("invalid test case: generated file not starting with test/")
-        try:
-            os.unlink(filename)
-        except OSError:
-            pass
+    _remove_files(expect_output_files.keys())
     if prepare_function != None:
         prepare_function()
-    errors = []
-    input = b'\n'.join(map(to_bytes, input)) + b'\n'
-    asan_temp = tempfile.TemporaryDirectory()
+    if _input_bytes == None:
+        _input_bytes = encode_input(input)
+    stdout_matcher = _LineMatcher('stdout', _compiled_stdout, allow_extra_stdout)
+    stderr_matcher = _LineMatcher('stderr', _compiled_stderr, allow_extra_stderr)
     if seperate_asan:
-        my_env = os.environ.copy()
-        my_env['ASAN_OPTIONS'] = 'halt_on_error=0:log_path={}/asan_log:print_legend=0:alloc_dealloc_mismatch=0'.format(asan_temp.name)
-        extra_popen['env'] = my_env
-    process = subprocess.Popen(
-        PROGRAM,
-        stdin=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        **extra_popen
-    )
-    try:
-        out_data, err_data = process.communicate(input, timeout=timeout)
-    except subprocess.TimeoutExpired as to:
-        out_data = to.output
-        if out_data == None:
-            out_data = b''
-        if sys.version_info >= (3, 5):
-            err_data = to.stderr
-        else:
-            err_data = b'<error output not available>'
-        if err_data == None:
-            err_data = b'<error output not available>'
-        errors += [ 'timed out after {} seconds'.format(timeout) ]
-    errors += compare_lines(
-        'stdout',
-        stdout,
-        out_data.split(b'\n'),
-        allow_extra_lines=allow_extra_stdout,
-    )
-    errors += compare_lines(
-        'stderr',
-        stderr,
-        err_data.split(b'\n'),
-        allow_extra_lines=allow_extra_stderr,
-    )
+        with tempfile.TemporaryDirectory() as asan_dir:
+            my_env = os.environ.copy()
+            my_env['ASAN_OPTIONS'] = 'halt_on_error=0:log_path={}/asan_log:print_legend=0:alloc_dealloc_mismatch=0'.format(asan_dir)
+            pid, out_data, err_data, errors = _run_shell(_input_bytes, timeout, dict(extra_popen, env=my_env), stdout_matcher, stderr_matcher)
+            asan_result = _read_asan_logs(asan_dir, pid)
+    else:
+        pid, out_data, err_data, errors = _run_shell(_input_bytes, timeout, extra_popen, stdout_matcher, stderr_matcher)
+        asan_result = {}
+    # kept as bytes; only the lines a failure report shows get decoded
     result = {
-        'stdout': bytes_to_lines(out_data),
-        'stderr': bytes_to_lines(err_data),
+        'stdout': out_data.splitlines(),
+        'stderr': err_data.splitlines(),
     }
-    if seperate_asan:
-        asan_errors = []
-        asan_errors_children = []
-        leak_error = False
-        non_leak_error = False
-        for asan_log_file in os.listdir(asan_temp.name):
-            is_main = asan_log_file == 'asan_log.{}'.format(process.pid)
-            if asan_log_file.startswith('asan_log.'):
-                with open(os.path.join(asan_temp.name, asan_log_file), 'r') as fh:
-                    for line in fh:
-                        line = line.replace('\n','')
-                        if is_main:
-                            asan_errors.append(line)
-                            if 'leak' in line:
-                                leak_error = True
-                            elif 'ERROR' in line:
-                                non_leak_error = True
-                        else:
-                            asan_errors_children.append(line)
-        result['asan_errors'] = asan_errors
-        result['asan_errors_children'] = asan_errors_children
-        result['asan_leak'] = leak_error
-        result['asan_non_leak'] = non_leak_error
-    for filename, expected_contents in sorted(expect_output_files.items()):
+    result.update(asan_result)
+    # in the order the test lists them, so reports follow the test table
+    for filename, expected_contents in expect_output_files.items():
         try:
-            if ignore_output_permissions:
-                try:
-                    if not os.access(filename, os.R_OK):
-                        os.chmod(filename, 0o666)
-                except OSError:
-                    pass
-            with open(filename, 'rb') as fh:
-                lines = list(map(lambda x: x[:-1] if x.endswith(b'\n') else x, fh.readlines()))
-                errors += compare_lines(
-                    'created file {}'.format(filename),
-                    expected_contents,
-                    lines,
-                    allow_extra_lines=False
-                )
-            os.unlink(filename)
+            try:
+                fh = open(filename, 'rb')
+            except PermissionError:
+                if not ignore_output_permissions:
+                    raise
+                os.chmod(filename, 0o666)
+                fh = open(filename, 'rb')
+            with fh:
+                lines = fh.read().splitlines()
+            errors += compare_lines(
+                'created file {}'.format(filename),
+                _compiled_output_files[filename] if _compiled_output_files != None else compile_patterns(expected_contents),
+                lines,
+                allow_extra_lines=False
+            )
         except OSError as e:
             if e.errno == errno.ENOENT:
                 errors += [ 'file {} was not created'.format(filename) ]
             else:
                 errors += [ 'error {} while reading {}'.format(e, filename) ]
-    for filename in expect_output_files.keys():
-        if not filename.startswith('test/'):
-            raise Exception("invalid test case: generated file not starting with test/")
-        try:
-            os.unlink(filename)
-        except OSError:
-            pass
-    result['errors'] = errors
+    _remove_files(expect_output_files.keys())
+    log.debug('test %s: shell pid %s, %d errors', name, pid, len(errors))
+    result['errors'] = _limit_errors(errors)
     return result
 
+def _is_batchable(test):
+    # the final 'exit' is replaced by the next test's input (what the shell
+    # does on exit is only checked once, when the batch shell exits), so only
+    # tests that end with it (and do nothing else the shell might exit on)
+    # qualify
+    input = test['input']
+    return (
+        len(input) > 1 and input[-1] == 'exit'
+        and all(line.strip() and line.strip() != 'exit' for line in input[:-1])
+        and not _is_exclusive(test)
+        and 'timeout' not in test
+    )
+
+def _batch_marker(index):
+    return to_bytes('__MSH_SENTINEL_{}__'.format(index))
+
+def _batch_segment(data, index):
+    # output of test `index` runs from the end of the last line mentioning its
+    # sentinel (the sentinel's own exit status) up to the next sentinel's echo;
+    # the prompt printed before that echo belongs to the test, like the final
+    # prompt before 'exit' does in a standalone run
+    end = data.find(_batch_marker(index + 1))
+    if end == -1:
+        return None
+    start = data.rfind(_batch_marker(index), 0, end)
+    if start == -1:
+        return None
+    start = data.find(b'\n', start, end)
+    if start == -1:
+        return None
+    return data[start + 1:end]
+
+class _OutputCollector(object):
+    # Reads one of the batch shell's output streams in the background so the
+    # batch runner can wait for a sentinel to show up in it.
+    def __init__(self, stream):
+        self.data = bytearray()
+        self.closed = False
+        self.condition = threading.Condition()
+        thread = threading.Thread(target=self._collect, args=(stream,))
+        thread.daemon = True
+        thread.start()
+
+    def _collect(self, stream):
+        for chunk in iter(stream.readline, b''):
+            with self.condition:
+                self.data += chunk
+                self.condition.notify_all()
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def wait_for(self, marker, deadline):
+        with self.condition:
+            while self.data.find(marker) == -1:
+                remaining = deadline - time.monotonic()
+                if self.closed or remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            return True
+
+    def wait_closed(self, deadline):
+        with self.condition:
+            while not self.closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            return True
+
+    def segment(self, index):
+        with self.condition:
+            return _batch_segment(bytes(self.data), index)
+
+    def tail(self, index):
+        # everything after the line that echoed sentinel `index`
+        with self.condition:
+            data = bytes(self.data)
+        start = data.rfind(_batch_marker(index))
+        if start == -1:
+            return None
+        start = data.find(b'\n', start)
+        if start == -1:
+            return None
+        return data[start + 1:]
+
+def _send_lines(process, lines):
+    try:
+        process.stdin.write(encode_input(lines))
+        process.stdin.flush()
+        return True
+    except BrokenPipeError:
+        return False
+
+def _sentinel_command(index):
+    return '{} {}'.format(SENTINEL_PROGRAM, _batch_marker(index).decode('UTF-8'))
+
+def run_test_batch(tests):
+    # Run several tests in one long-lived shell. Each test's input (without its
+    # final 'exit') is sent only after the previous test's closing sentinel has
+    # appeared on both stdout and stderr, so every test gets its own timeout.
+    # A test that does not pass this way is re-run on its own with run_test.
+    # No test's own 'exit' runs here, so the batch is only trusted if the
+    # shell's single real exit is clean: status 0, nothing on stderr and
+    # nothing but the final prompt on stdout after the last sentinel. A leak
+    # report, crash or stray output at exit, like a hang or an early exit,
+    # makes every test in the batch run on its own.
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug('running %d tests in one shell: %s', len(tests), '; '.join(test['name'] for test in tests))
+    process = subprocess.Popen(
+        PROGRAM,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    stdout = _OutputCollector(process.stdout)
+    stderr = _OutputCollector(process.stderr)
+    alive = _send_lines(process, [_sentinel_command(0)])
+    batched = []
+    for index, test in enumerate(tests):
+        result = None
+        if alive:
+            alive = _send_lines(process, list(test['input'][:-1]) + [_sentinel_command(index + 1)])
+            marker = _batch_marker(index + 1)
+            deadline = time.monotonic() + test.get('timeout', 5)
+            alive = alive and stdout.wait_for(marker, deadline) and stderr.wait_for(marker, deadline)
+        if not alive:
+            break
+        out_segment = stdout.segment(index)
+        err_segment = stderr.segment(index)
+        if out_segment != None and err_segment != None:
+            errors = _compare_output(
+                out_segment, err_segment,
+                test.get('_compiled_stdout') or compile_patterns(test['stdout']),
+                test.get('_compiled_stderr') or compile_patterns(test['stderr']),
+                test.get('allow_extra_stdout', False), test.get('allow_extra_stderr', False),
+            )
+            if len(errors) == 0:
+                result = {
+                    'stdout': out_segment.splitlines(),
+                    'stderr': err_segment.splitlines(),
+                    'errors': errors,
+                }
+        batched.append(result)
+    trusted = alive and _send_lines(process, ['exit'])
+    try:
+        process.stdin.close()
+    except BrokenPipeError:
+        pass
+    try:
+        process.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+        trusted = False
+    if trusted:
+        deadline = time.monotonic() + 5
+        trusted = (
+            process.returncode == 0
+            and stdout.wait_closed(deadline) and stderr.wait_closed(deadline)
+            and stdout.tail(len(tests)) in (b'', BATCH_FINAL_PROMPT)
+            and stderr.tail(len(tests)) == b''
+        )
+    if not trusted:
+        log.debug('batch shell did not exit cleanly (status %s), re-running all %d tests', process.returncode, len(tests))
+        batched = []
+    batched += [None] * (len(tests) - len(batched))
+    results = []
+    for test, result in zip(tests, batched):
+        if result == None:
+            log.debug('re-running test %s on its own', test['name'])
+            result = run_test(**test)
+        results.append(result)
+    return results
+
 def _output_with_limit(label, value, max_lines, output_to, annotate=None):
     annotate_string = "" if annotate == None else " ({})".format(annotate)
-    print("{}:{}".format(label, annotate_string))
+    shown = [
+        line.decode('UTF-8', errors='replace') if isinstance(line, bytes) else line
+        for line in value[0:max_lines]
+    ]
+    text = "{}:{}\n".format(label, annotate_string)
     if len(value) == 0:
-        print("  <empty>", file=output_to)
-    for line in value[0:max_lines]:
-        print("  {}".format(line), file=output_to)
+        text += "  <empty>\n"
+    if shown:
+        text += "  " + "\n  ".join(map(str, shown)) + "\n"
     if len(value) > max_lines:
-        print("  [plus {} more lines, not shown]".format(len(value) - max_lines), file=output_to)
+        text += "  [plus {} more lines, not shown]\n".format(len(value) - max_lines)
+    output_to.write(text)
+
+def _is_exclusive(test):
+    # tests that write shared files or change resource limits in preexec_fn
+    # (which is not safe while other threads are running) must run on their own
+    return bool(test.get('expect_output_files')) or 'prepare_function' in test or 'extra_popen' in test
+
+SKIPPED = {'errors': [], 'skipped': True}
+
+def _run_group(tests, group, seperate_asan, skip_test):
+    # returns (index, result) pairs; indexes skip_test rejects are not run
+    pairs = [(index, SKIPPED) for index in group if skip_test(index)]
+    group = [index for index in group if not skip_test(index)]
+    if len(group) == 1:
+        pairs.append((group[0], run_test(seperate_asan=seperate_asan, **tests[group[0]])))
+    elif len(group) > 1:
+        pairs += zip(group, run_test_batch([tests[index] for index in group]))
+    return pairs
+
+def _iter_results(tests, jobs, seperate_asan, batch=False, skip_test=lambda index: False):
+    # yields (index, result) pairs as tests finish, not necessarily in order
+    groups = []
+    exclusive = []
+    batched = []
+    for index, test in enumerate(tests):
+        if jobs > 1 and _is_exclusive(test):
+            exclusive.append([index])
+        elif batch and not seperate_asan and _is_batchable(test):
+            batched.append(index)
+        else:
+            groups.append([index])
+    for start in range(0, len(batched), BATCH_SIZE):
+        groups.append(batched[start:start + BATCH_SIZE])
+    if jobs > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+            futures = [pool.submit(_run_group, tests, group, seperate_asan, skip_test) for group in groups]
+            for future in concurrent.futures.as_completed(futures):
+                for pair in future.result():
+                    yield pair
+    else:
+        for group in groups:
+            for pair in _run_group(tests, group, seperate_asan, skip_test):
+                yield pair
+    for group in exclusive:
+        for pair in _run_group(tests, group, seperate_asan, skip_test):
+            yield pair
 
-def run_and_output_tests(tests, max_lines=5, output_to=sys.stdout, verbose=False, seperate_asan=False):
-    categories = {}
+class _EarlyAbort(object):
+    # Decides, in report order, when the remaining tests can no longer change
+    # the outcome: after the first failure with fail_fast, or once a category
+    # has reached its threshold score or can no longer reach it. Workers check
+    # skips() before starting a test; since decisions are only ever added, a
+    # test skipped by a worker is also skipped when it is reported.
+    def __init__(self, descriptors, fail_fast, category_threshold):
+        self.fail_fast = fail_fast
+        self.thresholds = category_threshold or {}
+        self.stopped = False
+        self.decided = set()
+        self.scores = collections.Counter()
+        self.remaining = collections.Counter()
+        for test in descriptors:
+            self.remaining[test.category] += test.points
+        for category_name in self.thresholds:
+            self._check(category_name)
+
+    def skips(self, test):
+        return self.stopped or test.category in self.decided
+
+    def record(self, test, passed):
+        self.remaining[test.category] -= test.points
+        if passed:
+            self.scores[test.category] += test.points
+        elif self.fail_fast:
+            self.stopped = True
+        self._check(test.category)
+
+    def _check(self, category_name):
+        threshold = self.thresholds.get(category_name)
+        if threshold == None:
+            return
+        score = self.scores[category_name]
+        if score >= threshold or score + self.remaining[category_name] < threshold:
+            self.decided.add(category_name)
+
+def _output_asan(result, max_lines, output_to):
+    if result.get('asan_errors') != None:
+        if len(result['asan_errors']) > 0:
+            _output_with_limit('AddressSanitizer output (main process)', result['asan_errors'], max_lines, output_to)
+        if len(result['asan_errors_children']) > 0:
+            _output_with_limit('AddressSanitizer output (child processes)', result['asan_errors_children'], max_lines, output_to)
+
+# what the report loop needs from a test, looked up once per run instead of
+# with repeated .get() calls; the workers still run the test dicts themselves
+TestDescriptor = collections.namedtuple('TestDescriptor', [
+    'name',
+    'category',
+    'points',
+    'input',
+    'stdout',
+    'stderr',
+    'allow_extra_stdout',
+    'allow_extra_stderr',
+    'has_extra_setup',
+])
+
+def _describe(test):
+    return TestDescriptor(
+        name=test['name'],
+        category=test.get('category', '(none)'),
+        points=test.get('points', 0),
+        input=test['input'],
+        stdout=test['stdout'],
+        stderr=test['stderr'],
+        allow_extra_stdout=test.get('allow_extra_stdout', False),
+        allow_extra_stderr=test.get('allow_extra_stderr', False),
+        has_extra_setup='extra_popen' in test or 'prepare_function' in test,
+    )
+
+def _render_result(test, result, max_lines, verbose):
+    output_to = io.StringIO()
+    name = test.name
+    errors = result['errors']
+    if len(errors) == 0:
+        if verbose:
+            print("Passed test", name, file=output_to)
+        _output_asan(result, max_lines, output_to)
+    else:
+        print("Failed test", name, file=output_to)
+        _output_with_limit('Test input', test.input, max_lines, output_to)
+        _output_with_limit('Actual stdout', result.get('stdout', '<unknown>'), max_lines, output_to)
+        _output_with_limit('Actual stderr', result.get('stderr', '<unknown>'), max_lines, output_to)
+        _output_asan(result, max_lines, output_to)
+        _output_with_limit('Expected stdout regular expression pattern', test.stdout, max_lines, output_to,
+            "extra lines allowed" if test.allow_extra_stdout else None
+        )
+        _output_with_limit('Expected stderr regular expression pattern', test.stderr, max_lines, output_to,
+            "extra lines allowed" if test.allow_extra_stderr else None
+        )
+        if test.has_extra_setup:
+            print("(This test also has some important extra setup code that might do something like restrict the number of file descriptors or child processes that can be created.)", file=output_to)
+        _output_with_limit('Errors', errors, max_lines, output_to)
+    return output_to.getvalue()
+
+def _new_category():
+    return {
+        'possible': 0,
+        'score': 0,
+        'failed': [],
+        'passed': [],
+        'skipped': [],
+    }
+
+def run_and_output_tests(
+        tests,
+        max_lines=5,
+        output_to=sys.stdout,
+        verbose=False,
+        seperate_asan=False,
+        jobs=1,
+        batch=False,
+        fail_fast=False,
+        category_threshold=None,
+):
+    # With fail_fast, every test after the first failure is skipped. With
+    # category_threshold ({category: points needed}), tests are grouped by
+    # category and the rest of a category is skipped once its pass/fail
+    # outcome is settled. Skipped tests still count towards 'possible'.
+    if category_threshold:
+        tests = sorted(tests, key=lambda test: test.get('category', '(none)'))
+    descriptors = [_describe(test) for test in tests]
+    abort = _EarlyAbort(descriptors, fail_fast, category_threshold)
+    categories = collections.defaultdict(_new_category)
     total_passed = 0
     total_failed = 0
+    total_skipped = 0
     total_score = 0
     total_possible = 0
     asan_leaks = 0
     asan_non_leaks = 0
     both_asan = 0
-    for test in tests:
-        name = test['name']
-        category_name = test.get('category', '(none)')
-        if category_name not in categories:
-            categories[category_name] = {
-                'possible': 0,
-                'score': 0,
-                'failed': [],
-                'passed': [],
-            }
-        category = categories[category_name]
-        points = test.get('points', 0)
-        category['possible'] += points
-        total_possible += points
-        result = run_test(seperate_asan=seperate_asan, **test)
-        errors = result['errors']
-        if len(errors) == 0:
-            total_passed += 1
-            category['score'] += points
-            total_score += points
-            category['passed'].append(name)
-            if verbose:
-                print("Passed test", name, file=output_to)
-            if result.get('asan_errors') != None:
-                if len(result['asan_errors']) > 0:
-                    _output_with_limit('AddressSanitizer output (main process)', result['asan_errors'], max_lines, output_to)
-                if len(result['asan_errors_children']) > 0:
-                    _output_with_limit('AddressSanitizer output (child processes)', result['asan_errors_children'], max_lines, output_to)
-            asan_leaks += points if result.get('asan_leak', False) else 0
-            asan_non_leaks += points if result.get('asan_non_leak', False) else 0
-            both_asan += points if result.get('asan_leak', False) and result.get('asan_non_leak', False) else 0
-        else:
-            total_failed += 1
-            print("Failed test", name, file=output_to)
-            category['failed'].append(name)
-            _output_with_limit('Test input', test['input'], max_lines, output_to)
-            _output_with_limit('Actual stdout', result.get('stdout', '<unknown>'), max_lines, output_to)
-            _output_with_limit('Actual stderr', result.get('stderr', '<unknown>'), max_lines, output_to)
-            if result.get('asan_errors') != None:
-                if len(result['asan_errors']) > 0:
-                    _output_with_limit('AddressSanitizer output (main process)', result['asan_errors'], max_lines, output_to)
-                if len(result['asan_errors_children']) > 0:
-                    _output_with_limit('AddressSanitizer output (child processes)', result['asan_errors_children'], max_lines, output_to)
-            _output_with_limit('Expected stdout regular expression pattern', test['stdout'], max_lines, output_to,
-                "extra lines allowed" if test.get('allow_extra_stdout', False) else None
-            )
-            _output_with_limit('Expected stderr regular expression pattern', test['stderr'], max_lines, output_to,
-                "extra lines allowed" if test.get('allow_extra_stderr', False) else None
-            )
-            if 'extra_popen' in test or 'prepare_function' in test:
-                print("(This test also has some important extra setup code that might do something like restrict the number of file descriptors or child processes that can be created.)", file=output_to)
-            _output_with_limit('Errors', errors, max_lines, output_to)
+    _warm_pattern_cache(tests)
+    # tests may finish out of order; each one is reported as soon as every
+    # test before it has been
+    finished = {}
+    next_index = 0
+    skip_test = lambda index: abort.skips(descriptors[index])
+    for index, result in _iter_results(tests, jobs, seperate_asan, batch, skip_test):
+        finished[index] = result
+        while next_index in finished:
+            test = descriptors[next_index]
+            result = finished.pop(next_index)
+            next_index += 1
+            name = test.name
+            category = categories[test.category]
+            points = test.points
+            category['possible'] += points
+            total_possible += points
+            if abort.skips(test):
+                total_skipped += 1
+                category['skipped'].append(name)
+                if verbose:
+                    print("Skipped test", name, file=output_to)
+                continue
+            abort.record(test, len(result['errors']) == 0)
+            if len(result['errors']) == 0:
+                total_passed += 1
+                category['score'] += points
+                total_score += points
+                category['passed'].append(name)
+                asan_leaks += points if result.get('asan_leak', False) else 0
+                asan_non_leaks += points if result.get('asan_non_leak', False) else 0
+                both_asan += points if result.get('asan_leak', False) and result.get('asan_non_leak', False) else 0
+            else:
+                total_failed += 1
+                category['failed'].append(name)
+            output_to.write(_render_result(test, result, max_lines, verbose))
+            output_to.flush()
     return {
-        'by_category': categories,
+        'by_category': dict(categories),
         'total_passed': total_passed,
         'total_failed': total_failed,
+        'total_skipped': total_skipped,
         'total_score': total_score,
         'total_possible': total_possible,
         'asan_leaks': asan_leaks,
@@ -974,13 +1568,27 @@ def run_and_output_tests(tests, max_lines=5, output_to=sys.stdout, verbose=False
 
 
 if __name__ == '__main__':
-    logging.basicConfig(level=logging.DEBUG)
-    if len(sys.argv) > 1 and sys.argv[1] == 'non-pipe':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('suite', nargs='?', choices=['non-pipe'])
+    parser.add_argument('--batch', action='store_true',
+        help='run compatible tests several at a time in one shell process; '
+            'if that shell does not exit cleanly, its tests are re-run one by one')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+        help='number of tests to run at the same time (default: 1; up to the '
+            'number of CPUs, {} here, is useful)'.format(os.cpu_count() or 1))
+    parser.add_argument('--fail-fast', action='store_true',
+        help='skip the remaining tests after the first failure')
+    parser.add_argument('--quiet', '-q', action='store_true',
+        help='only log warnings, even if SHELL_TEST_DEBUG is set')
+    args = parser.parse_args()
+    debug = os.environ.get('SHELL_TEST_DEBUG') and not args.quiet
+    logging.basicConfig(level=logging.DEBUG if debug else logging.WARNING)
+    if args.suite == 'non-pipe':
         TESTS = NON_PIPE_TESTS
-    elif len(sys.argv) > 1:
-        raise Exception("Unrecognized arguments {}".format(sys.argv))
-    result = run_and_output_tests(TESTS)
+    result = run_and_output_tests(TESTS, jobs=args.jobs, batch=args.batch, fail_fast=args.fail_fast)
     print("{} tests passed and {} tests failed.".format(result['total_passed'], result['total_failed']))
+    if result['total_skipped'] > 0:
+        print("{} tests skipped.".format(result['total_skipped']))
     if result['total_failed'] > 0:
         print("""---
 Note on interpreting test output patterns:
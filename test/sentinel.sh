@@ -0,0 +1,3 @@
+#!/bin/sh
+echo "$1"
+echo "$1" 1>&2